@@ -6,18 +6,11 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-import time
-import json 
 import numpy as np
 import cv2
-import random
 import torch
-import torch.nn as nn
 from tqdm import tqdm
-from torch.utils.data import DataLoader
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib
+from torch.utils.data import DataLoader, Subset
 from numpy.linalg import inv
 
 from lib.options import BaseOptions
@@ -26,106 +19,103 @@ from lib.data import EvalWPoseDataset, EvalDataset
 from lib.model import HGPIFuNetwNML, HGPIFuMRNet
 from lib.geometry import index
 
-from PIL import Image
-
 parser = BaseOptions()
 
-def gen_mesh(res, net, cuda, data, save_path, thresh=0.5, use_octree=True, components=False):
-    image_tensor_global = data['img_512'].to(device=cuda)
-    image_tensor = data['img'].to(device=cuda)
-    calib_tensor = data['calib'].to(device=cuda)
+def collate_single(batch):
+    # samples are fed one at a time, keep them unbatched as returned by the dataset
+    return batch[0]
+
+def save_image(save_img_path, images):
+    '''
+    save images side by side with a single device to host copy.
+    args:
+        images: [V, 3, H, W] images normalized to [-1, 1]
+    '''
+    images = ((images.detach().permute(0, 2, 3, 1) * 0.5 + 0.5) * 255.0).clamp(0, 255).round().byte()
+    images = images.cpu().numpy()[:, :, :, ::-1]
+    cv2.imwrite(save_img_path, np.concatenate(list(images), axis=1))
+
+def gen_mesh(res, net, cuda, data, save_path, thresh=0.5, use_octree=True, components=False, save_viz=False, num_samples=50000):
+    image_tensor_global = data['img_512'].to(device=cuda, non_blocking=True)
+    image_tensor = data['img'].to(device=cuda, non_blocking=True)
+    calib_tensor = data['calib'].to(device=cuda, non_blocking=True)
 
     net.filter_global(image_tensor_global)
     net.filter_local(image_tensor[:,None])
 
-    try:
+    # the predicted normal maps are only appended to the saved image on request
+    if save_viz:
         if net.netG.netF is not None:
             image_tensor_global = torch.cat([image_tensor_global, net.netG.nmlF], 0)
         if net.netG.netB is not None:
             image_tensor_global = torch.cat([image_tensor_global, net.netG.nmlB], 0)
-    except:
-        pass
     
+    save_img_path = save_path[:-4] + '.png'
+    save_image(save_img_path, image_tensor_global)
+    # the visualization is only needed for the image above, free it before the grid queries
+    del image_tensor_global
+
     b_min = data['b_min']
     b_max = data['b_max']
-    try:
-        save_img_path = save_path[:-4] + '.png'
-        save_img_list = []
-        for v in range(image_tensor_global.shape[0]):
-            save_img = (np.transpose(image_tensor_global[v].detach().cpu().numpy(), (1, 2, 0)) * 0.5 + 0.5)[:, :, ::-1] * 255.0
-            save_img_list.append(save_img)
-        save_img = np.concatenate(save_img_list, axis=1)
-        cv2.imwrite(save_img_path, save_img)
-
-        verts, faces, _, _ = reconstruction(
-            net, cuda, calib_tensor, res, b_min, b_max, thresh, use_octree=use_octree, num_samples=50000)
-        verts_tensor = torch.from_numpy(verts.T).unsqueeze(0).to(device=cuda).float()
-        # if 'calib_world' in data:
-        #     calib_world = data['calib_world'].numpy()[0]
-        #     verts = np.matmul(np.concatenate([verts, np.ones_like(verts[:,:1])],1), inv(calib_world).T)[:,:3]
-
-        color = np.zeros(verts.shape)
-        interval = 50000
-        for i in range(len(color) // interval + 1):
-            left = i * interval
-            if i == len(color) // interval:
-                right = -1
-            else:
-                right = (i + 1) * interval
-            net.calc_normal(verts_tensor[:, None, :, left:right], calib_tensor[:,None], calib_tensor)
-            nml = net.nmls.detach().cpu().numpy()[0] * 0.5 + 0.5
-            color[left:right] = nml.T
-
-        save_obj_mesh_with_color(save_path, verts, faces, color)
-    except Exception as e:
-        print(e)
-
-
-def gen_mesh_imgColor(res, net, cuda, data, save_path, thresh=0.5, use_octree=True, components=False):
-    image_tensor_global = data['img_512'].to(device=cuda)
-    image_tensor = data['img'].to(device=cuda)
-    calib_tensor = data['calib'].to(device=cuda)
+    mesh = reconstruction(
+        net, cuda, calib_tensor, res, b_min, b_max, thresh, use_octree=use_octree, num_samples=num_samples)
+    if mesh == -1:
+        return
+    verts, faces, _, _ = mesh
+    # [B1, B2, 3, N] / [B1, B2, 4, 4] views in the layout calc_normal expects
+    verts_tensor = torch.from_numpy(np.ascontiguousarray(verts.T, dtype=np.float32)).to(device=cuda)[None, None]
+    calib_local = calib_tensor[:, None]
+    # if 'calib_world' in data:
+    #     calib_world_inv = inv(data['calib_world'].numpy()[0])
+    #     verts = np.matmul(verts, calib_world_inv[:3, :3].T) + calib_world_inv[:3, 3]
+
+    # all vertices go through a single call; only the mlps are chunked internally
+    net.calc_normal(verts_tensor, calib_local, calib_tensor, chunk_size=num_samples)
+    color = (net.nmls.detach()[0].t().float() * 0.5 + 0.5).cpu().numpy()
+
+    save_obj_mesh_with_color(save_path, verts, faces, color)
+
+
+def gen_mesh_imgColor(res, net, cuda, data, save_path, thresh=0.5, use_octree=True, components=False, save_viz=False, num_samples=100000):
+    image_tensor_global = data['img_512'].to(device=cuda, non_blocking=True)
+    image_tensor = data['img'].to(device=cuda, non_blocking=True)
+    calib_tensor = data['calib'].to(device=cuda, non_blocking=True)
 
     net.filter_global(image_tensor_global)
     net.filter_local(image_tensor[:,None])
 
-    try:
+    # the predicted normal maps are only appended to the saved image on request
+    if save_viz:
         if net.netG.netF is not None:
             image_tensor_global = torch.cat([image_tensor_global, net.netG.nmlF], 0)
         if net.netG.netB is not None:
             image_tensor_global = torch.cat([image_tensor_global, net.netG.nmlB], 0)
-    except:
-        pass
+
+    save_img_path = save_path[:-4] + '.png'
+    save_image(save_img_path, image_tensor_global)
+    # the visualization is only needed for the image above, free it before the grid queries
+    del image_tensor_global
 
     b_min = data['b_min']
     b_max = data['b_max']
-    try:
-        save_img_path = save_path[:-4] + '.png'
-        save_img_list = []
-        for v in range(image_tensor_global.shape[0]):
-            save_img = (np.transpose(image_tensor_global[v].detach().cpu().numpy(), (1, 2, 0)) * 0.5 + 0.5)[:, :, ::-1] * 255.0
-            save_img_list.append(save_img)
-        save_img = np.concatenate(save_img_list, axis=1)
-        cv2.imwrite(save_img_path, save_img)
-
-        verts, faces, _, _ = reconstruction(
-            net, cuda, calib_tensor, res, b_min, b_max, thresh, use_octree=use_octree, num_samples=100000)
-        verts_tensor = torch.from_numpy(verts.T).unsqueeze(0).to(device=cuda).float()
-
-        # if this returns error, projection must be defined somewhere else
-        xyz_tensor = net.projection(verts_tensor, calib_tensor[:1])
-        uv = xyz_tensor[:, :2, :]
-        color = index(image_tensor[:1], uv).detach().cpu().numpy()[0].T
-        color = color * 0.5 + 0.5
+    mesh = reconstruction(
+        net, cuda, calib_tensor, res, b_min, b_max, thresh, use_octree=use_octree, num_samples=num_samples)
+    if mesh == -1:
+        return
+    verts, faces, _, _ = mesh
+    verts_tensor = torch.from_numpy(verts.T).unsqueeze(0).to(device=cuda).float()
 
-        if 'calib_world' in data:
-            calib_world = data['calib_world'].numpy()[0]
-            verts = np.matmul(np.concatenate([verts, np.ones_like(verts[:,:1])],1), inv(calib_world).T)[:,:3]
+    # if this returns error, projection must be defined somewhere else
+    xyz_tensor = net.projection(verts_tensor, calib_tensor[:1])
+    uv = xyz_tensor[:, :2, :]
+    color = index(image_tensor[:1], uv).detach().cpu().numpy()[0].T
+    color = color * 0.5 + 0.5
 
-        save_obj_mesh_with_color(save_path, verts, faces, color)
+    if 'calib_world' in data:
+        calib_world_inv = inv(data['calib_world'].numpy()[0])
+        verts = np.matmul(verts, calib_world_inv[:3, :3].T) + calib_world_inv[:3, 3]
 
-    except Exception as e:
-        print(e)
+    save_obj_mesh_with_color(save_path, verts, faces, color)
 
 
 def recon(opt, use_rect=False):
@@ -153,12 +143,22 @@ def recon(opt, use_rect=False):
         resolution = opt.resolution
         results_path = opt.results_path
         loadSize = opt.loadSize
+        num_threads = opt.num_threads
+        num_samples = opt.num_samples
+        save_viz = opt.save_viz
+        use_amp = opt.use_amp
+        use_compile = opt.use_compile
         
         opt = state_dict['opt']
         opt.dataroot = dataroot
         opt.resolution = resolution
         opt.results_path = results_path
         opt.loadSize = loadSize
+        opt.num_threads = num_threads
+        opt.num_samples = num_samples
+        opt.save_viz = save_viz
+        opt.use_amp = use_amp
+        opt.use_compile = use_compile
     else:
         raise Exception('failed loading state dict!', state_dict_path)
     
@@ -182,6 +182,16 @@ def recon(opt, use_rect=False):
     # load checkpoints
     netMR.load_state_dict(state_dict['model_state_dict'])
 
+    # the mlps dominate query time. the number of query points changes between
+    # chunks, so they are compiled for dynamic shapes. this is done after loading
+    # since compiled modules prefix their state dict keys.
+    if opt.use_compile:
+        if hasattr(torch, 'compile'):
+            netG.mlp = torch.compile(netG.mlp, dynamic=True)
+            netMR.mlp = torch.compile(netMR.mlp, dynamic=True)
+        else:
+            print('Warning: torch.compile requires pytorch >= 2.0, running eagerly.')
+
     os.makedirs(opt.checkpoints_path, exist_ok=True)
     os.makedirs(opt.results_path, exist_ok=True)
     os.makedirs('%s/%s/recon' % (opt.results_path, opt.name), exist_ok=True)
@@ -192,28 +202,28 @@ def recon(opt, use_rect=False):
         end_id = len(test_dataset)
 
     ## test
-    with torch.no_grad():
+    with torch.inference_mode(), torch.cuda.amp.autocast(enabled=opt.use_amp and cuda.type == 'cuda'):
         set_eval()
 
         print('generate mesh (test) ...')
-        for i in tqdm(range(start_id, end_id)):
-            if i >= len(test_dataset):
-                break
-            
+        # worker processes prepare the next samples while the current one is reconstructed
+        test_ids = range(start_id, min(end_id, len(test_dataset)))
+        test_loader = DataLoader(Subset(test_dataset, test_ids), batch_size=1,
+                                 num_workers=opt.num_threads, pin_memory=cuda.type == 'cuda',
+                                 collate_fn=collate_single)
+        for i, test_data in zip(test_ids, tqdm(test_loader)):
             # for multi-person processing, set it to False
             if True:
-                test_data = test_dataset[i]
-
                 save_path = '%s/%s/recon/result_%s_%d.obj' % (opt.results_path, opt.name, test_data['name'], opt.resolution)
 
                 print(save_path)
-                gen_mesh(opt.resolution, netMR, cuda, test_data, save_path, components=opt.use_compose)
+                gen_mesh(opt.resolution, netMR, cuda, test_data, save_path, components=opt.use_compose, save_viz=opt.save_viz, num_samples=opt.num_samples)
             else:
                 for j in range(test_dataset.get_n_person(i)):
                     test_dataset.person_id = j
                     test_data = test_dataset[i]
                     save_path = '%s/%s/recon/result_%s_%d.obj' % (opt.results_path, opt.name, test_data['name'], j)
-                    gen_mesh(opt.resolution, netMR, cuda, test_data, save_path, components=opt.use_compose)
+                    gen_mesh(opt.resolution, netMR, cuda, test_data, save_path, components=opt.use_compose, save_viz=opt.save_viz, num_samples=opt.num_samples)
 
 def reconWrapper(args=None, use_rect=False):
     opt = parser.parse(args)
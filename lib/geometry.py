@@ -21,6 +21,7 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
+from typing import Optional
 import torch
 
 def index(feat, uv):
@@ -37,6 +38,59 @@ def index(feat, uv):
     samples = torch.nn.functional.grid_sample(feat, uv, align_corners=True)
     return samples[:, :, :, 0]
 
+@torch.jit.script
+def index_feat(feat, uv, point_feat, out: Optional[torch.Tensor] = None):
+    '''
+    same as index, followed by appending per-point features.
+    scripted so that sampling and concatenation run without python dispatch.
+    args:
+        feat: [B, C, H, W] image features
+        uv: [B, 2, N] normalized image coordinates ranged in [-1, 1]
+        point_feat: [B, C', N] per-point features
+        out: optional [B, C+C', N] buffer to write into (not differentiable)
+    return:
+        [B, C+C', N] sampled pixel values concatenated with point_feat
+    '''
+    # sampled in fp32 like autocast does in eager mode, which scripted code does not get
+    uv = uv.float().transpose(1, 2).unsqueeze(2)
+    samples = torch.nn.functional.grid_sample(feat.float(), uv, align_corners=True)
+    if out is None:
+        return torch.cat([samples[:, :, :, 0], point_feat], 1)
+    return torch.cat([samples[:, :, :, 0], point_feat], 1, out=out)
+
+@torch.jit.script
+def in_bbox(xyz, dims: int = 3):
+    '''
+    test whether points lie inside the normalized [-1, 1] cube
+    args:
+        xyz: [B, 3, N] 3d coordinates in screen space
+        dims: number of leading coordinates to test
+    return:
+        [B, 1, N] 1 for points inside, 0 otherwise
+    '''
+    xyz = xyz[:, :dims, :]
+    inside = (xyz >= -1) & (xyz <= 1)
+    return inside.all(1, keepdim=True).float()
+
+@torch.jit.script
+def fd_normal(pred):
+    '''
+    surface normal from forward differences, fused into a single scripted graph
+    args:
+        pred: [B, 1, N*4] predictions at (p, p+dx, p+dy, p+dz) for each point
+    return:
+        [B, 3, N] unit normals, pointing against the gradient of the prediction
+    '''
+    # computed in fp32 so that the norm cannot underflow under autocast
+    pred = pred.float().view(pred.size(0), -1, 4)
+    # divide by delta is omitted since it's normalized anyway
+    nml = (pred[:, :, :1] - pred[:, :, 1:]).transpose(1, 2)
+    inv_norm = torch.rsqrt((nml * nml).sum(1, keepdim=True).clamp_min(1e-16))
+    return nml * inv_norm
+
+# screen coordinates stay in fp32 under autocast, fp16 cannot resolve the
+# finite-difference offsets used for normals
+@torch.cuda.amp.autocast(enabled=False)
 def orthogonal(points, calib, transform=None):
     '''
     project points onto screen space using orthogonal projection
@@ -47,15 +101,19 @@ def orthogonal(points, calib, transform=None):
     return:
         [B, 3, N] 3d coordinates in screen space
     '''
+    points = points.float()
+    calib = calib.float()
     rot = calib[:, :3, :3]
     trans = calib[:, :3, 3:4]
     pts = torch.baddbmm(trans, rot, points)
     if transform is not None:
+        transform = transform.float()
         scale = transform[:2, :2]
         shift = transform[:2, 2:3]
         pts[:, :2, :] = torch.baddbmm(shift, scale, pts[:, :2, :])
     return pts
 
+@torch.cuda.amp.autocast(enabled=False)
 def perspective(points, calib, transform=None):
     '''
     project points onto screen space using perspective projection
@@ -66,11 +124,14 @@ def perspective(points, calib, transform=None):
     return:
         [B, 3, N] 3d coordinates in screen space
     '''
+    points = points.float()
+    calib = calib.float()
     rot = calib[:, :3, :3]
     trans = calib[:, :3, 3:4]
     homo = torch.baddbmm(trans, rot, points)
     xy = homo[:, :2, :] / homo[:, 2:3, :]
     if transform is not None:
+        transform = transform.float()
         scale = transform[:2, :2]
         shift = transform[:2, 2:3]
         xy = torch.baddbmm(shift, scale, xy)
@@ -52,19 +52,17 @@ def reconstruction(net, cuda, calib_tensor,
     calib = calib_tensor[0].cpu().numpy()
 
     calib_inv = inv(calib)
-    coords = coords.reshape(3,-1).T
-    coords = np.matmul(np.concatenate([coords, np.ones((coords.shape[0],1))], 1), calib_inv.T)[:, :3]
-    coords = coords.T.reshape(3,resolution,resolution,resolution)
+    # apply the inverse as rotation + translation, no homogeneous copy of the grid
+    coords = np.matmul(calib_inv[:3, :3], coords.reshape(3,-1)) + calib_inv[:3, 3:4]
+    coords = coords.reshape(3,resolution,resolution,resolution)
 
     # Then we define the lambda function for cell evaluation
     def eval_func(points):
-        points = np.expand_dims(points, axis=0)
-        points = np.repeat(points, 1, axis=0)
-        samples = torch.from_numpy(points).to(device=cuda).float()
+        samples = torch.from_numpy(points[None]).to(device=cuda).float()
         
         net.query(samples, calib_tensor)
         pred = net.get_preds()[0][0]
-        return pred.detach().cpu().numpy()
+        return pred.detach().float().cpu().numpy()
 
     # Then we evaluate the grid
     if use_octree:
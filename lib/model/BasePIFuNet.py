@@ -30,6 +30,8 @@ class BasePIFuNet(nn.Module):
         self.labels_nml = None
         self.preds_surface = None # with normal loss only
 
+        self.scratch = {}
+
     def forward(self, points, images, calibs, transforms=None):
         '''
         args:
@@ -81,6 +83,63 @@ class BasePIFuNet(nn.Module):
         '''
         None
 
+    def perturb_points(self, points, delta):
+        '''
+        interleave points with their forward-difference perturbations.
+        args:
+            points: [B, 3, N] 3d points in world space
+            delta: perturbation for finite difference
+        return:
+            [B, 3, N*4] points ordered as (p, p+dx, p+dy, p+dz) for each point
+        '''
+        B, _, N = points.size()
+        if torch.is_grad_enabled():
+            points_all = points.new_empty(B, 3, N, 4)
+        else:
+            points_all = self.get_scratch('points_all', points, (B, 3, N, 4))
+        points_all.copy_(points[:, :, :, None].expand(-1, -1, -1, 4))
+        # element [b, k, n, k+1] is the k-th coordinate of the k-th perturbed copy
+        torch.diagonal(points_all[:, :, :, 1:], dim1=1, dim2=3).add_(delta)
+        return points_all.view(B, 3, -1)
+
+    def get_scratch(self, key, like, size):
+        '''
+        return an uninitialized tensor backed by a buffer that is reused across calls.
+        the buffer only grows, so chunks of varying size share one allocation.
+        the content is overwritten by the next call with the same key,
+        so this must not be used for tensors autograd saves for backward.
+        args:
+            key: name of the buffer
+            like: tensor whose dtype and device are used
+            size: requested size
+        return:
+            tensor of the given size
+        '''
+        numel = 1
+        for s in size:
+            numel *= s
+        buf = self.scratch.get(key)
+        # inference tensors cannot be updated in place outside inference mode, and vice versa
+        if buf is None or buf.numel() < numel or buf.dtype != like.dtype or buf.device != like.device \
+                or buf.is_inference() != torch.is_inference_mode_enabled():
+            buf = like.new_empty(numel)
+            self.scratch[key] = buf
+        return buf[:numel].view(*size)
+
+    def get_feat_buffer(self, im_feat, point_feat):
+        '''
+        return a reused buffer for image features concatenated with point features.
+        args:
+            im_feat: [B, C, ...] image features (only C is used)
+            point_feat: [B, C', N] per-point features
+        return:
+            [B, C+C', N] buffer, or None when autograd is enabled since out= is not differentiable
+        '''
+        if torch.is_grad_enabled():
+            return None
+        size = (point_feat.size(0), im_feat.size(1) + point_feat.size(1), point_feat.size(2))
+        return self.get_scratch('point_feat', point_feat, size)
+
     def get_preds(self):
         '''
         return the current prediction.
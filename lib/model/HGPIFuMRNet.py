@@ -9,6 +9,7 @@ from .MLP import MLP
 from .DepthNormalizer import DepthNormalizer
 from .HGFilters import HGFilter
 from ..net_util import init_net
+from ..geometry import index_feat, in_bbox, fd_normal
 import cv2
 
 class HGPIFuMRNet(BasePIFuNet):
@@ -152,9 +153,7 @@ class HGPIFuMRNet(BasePIFuNet):
             xy = xyz[:, :2, :]
 
             # if the point is outside bounding box, return outside.
-            in_bb = (xyz >= -1) & (xyz <= 1)
-            in_bb = in_bb[:, 0, :] & in_bb[:, 1, :]
-            in_bb = in_bb[:, None, :].detach().float()
+            in_bb = in_bbox(xyz.detach(), 2)
 
             self.netG.query(points=points[:,i], calibs=calib_global)
             preds_low.append(torch.stack(self.netG.intermediate_preds_list,0))
@@ -169,12 +168,28 @@ class HGPIFuMRNet(BasePIFuNet):
             if not self.opt.train_full_pifu:
                 z_feat = z_feat.detach()
                         
+            # without autograd, only points inside the bounding box go through the mlp.
+            # norms that mix statistics across points keep the dense path.
+            mixes_points = self.mlp.norm == 'group' or (self.mlp.norm == 'batch' and self.training)
+            packed = not torch.is_grad_enabled() and in_bb.size(0) == 1 and not mixes_points
+            if packed:
+                idx = in_bb[0, 0].nonzero()[:, 0]
+                packed = idx.numel() != in_bb.size(2)
+
             intermediate_preds_list = []
             for j, im_feat in enumerate(self.im_feat_list):
-                point_local_feat_list = [self.index(im_feat.view(-1,B,*im_feat.size()[1:])[:,i], xy), z_feat]
-                point_local_feat = torch.cat(point_local_feat_list, 1)
-                pred = self.mlp(point_local_feat)[0]
-                pred = in_bb * pred
+                im_feat = im_feat.view(-1,B,*im_feat.size()[1:])[:,i]
+                if packed:
+                    pred = in_bb.new_zeros(1, self.mlp.filters[-1].out_channels, in_bb.size(2))
+                    if idx.numel() != 0:
+                        z_feat_in = z_feat[:, :, idx]
+                        point_local_feat = index_feat(im_feat, xy[:, :, idx], z_feat_in, self.get_feat_buffer(im_feat, z_feat_in))
+                        # the mlp output is fp16 under autocast, index_put needs matching dtypes
+                        pred[:, :, idx] = self.mlp(point_local_feat)[0].to(pred.dtype)
+                else:
+                    point_local_feat = index_feat(im_feat, xy, z_feat, self.get_feat_buffer(im_feat, z_feat))
+                    pred = self.mlp(point_local_feat)[0]
+                    pred = in_bb * pred
                 intermediate_preds_list.append(pred)
 
             preds_interm.append(torch.stack(intermediate_preds_list,0))
@@ -189,7 +204,7 @@ class HGPIFuMRNet(BasePIFuNet):
             self.gamma = torch.cat(gammas,0)
             self.labels = torch.cat(newlabels,0)
 
-    def calc_normal(self, points, calib_local, calib_global, transforms=None, labels=None, delta=0.001, fd_type='forward'):
+    def calc_normal(self, points, calib_local, calib_global, transforms=None, labels=None, delta=0.001, fd_type='forward', chunk_size=None):
         '''
         return surface normal in 'model' space.
         it computes normal only in the last stack.
@@ -202,6 +217,7 @@ class HGPIFuMRNet(BasePIFuNet):
             labels: [B1, B2, 3, N] ground truth normal
             delta: perturbation for finite difference
             fd_type: finite difference type (forward/backward/central) 
+            chunk_size: if set, the mlps are evaluated on at most chunk_size points at once
         '''
         B = calib_local.size(1)
 
@@ -212,38 +228,31 @@ class HGPIFuMRNet(BasePIFuNet):
 
         nmls = []
         for i in range(B):
-            points_sub = points[:,i]
-            pdx = points_sub.clone()
-            pdx[:,0,:] += delta
-            pdy = points_sub.clone()
-            pdy[:,1,:] += delta
-            pdz = points_sub.clone()
-            pdz[:,2,:] += delta
-
-            points_all = torch.stack([points_sub, pdx, pdy, pdz], 3)
-            points_all = points_all.view(*points_sub.size()[:2],-1)
+            points_all = self.perturb_points(points[:,i], delta)
             xyz = self.projection(points_all, calib_local[:,i], transforms)
             xy = xyz[:, :2, :]
-
-
-            self.netG.query(points=points_all, calibs=calib_global, update_pred=False)
-            z_feat = self.netG.phi
-            if not self.opt.train_full_pifu:
-                z_feat = z_feat.detach()
-
-            point_local_feat_list = [self.index(im_feat[:,i], xy), z_feat]            
-            point_local_feat = torch.cat(point_local_feat_list, 1)
-            pred = self.mlp(point_local_feat)[0]
-
-            pred = pred.view(*pred.size()[:2],-1,4) # (B, 1, N, 4)
-
-            # divide by delta is omitted since it's normalized anyway
-            dfdx = pred[:,:,:,1] - pred[:,:,:,0]
-            dfdy = pred[:,:,:,2] - pred[:,:,:,0]
-            dfdz = pred[:,:,:,3] - pred[:,:,:,0]
-
-            nml = -torch.cat([dfdx,dfdy,dfdz], 1)
-            nml = F.normalize(nml, dim=1, eps=1e-8)
+            im_local_feat = self.index(im_feat[:,i], xy)
+
+            # each point comes with its 3 perturbed copies, so chunks are 4x wider
+            step = points_all.size(2) if chunk_size is None else 4 * chunk_size
+            pred = []
+            for left in range(0, points_all.size(2), step):
+                right = left + step
+                self.netG.query(points=points_all[:,:,left:right], calibs=calib_global, update_pred=False)
+                z_feat = self.netG.phi
+                if not self.opt.train_full_pifu:
+                    z_feat = z_feat.detach()
+
+                point_local_feat_list = [im_local_feat[:,:,left:right], z_feat]
+                point_local_feat = self.get_feat_buffer(im_local_feat, z_feat)
+                if point_local_feat is None:
+                    point_local_feat = torch.cat(point_local_feat_list, 1)
+                else:
+                    torch.cat(point_local_feat_list, 1, out=point_local_feat)
+                pred.append(self.mlp(point_local_feat)[0])
+            pred = torch.cat(pred, 2)
+
+            nml = fd_normal(pred)
 
             nmls.append(nml)
         
@@ -9,6 +9,7 @@ from .MLP import MLP
 from .DepthNormalizer import DepthNormalizer
 from .HGFilters import HGFilter
 from ..net_util import init_net
+from ..geometry import index_feat, in_bbox, fd_normal
 from ..networks import define_G
 import cv2
 
@@ -153,9 +154,7 @@ class HGPIFuNetwNML(BasePIFuNet):
         xy = xyz[:, :2, :]
 
         # if the point is outside bounding box, return outside.
-        in_bb = (xyz >= -1) & (xyz <= 1)
-        in_bb = in_bb[:, 0, :] & in_bb[:, 1, :] & in_bb[:, 2, :]
-        in_bb = in_bb[:, None, :].detach().float()
+        in_bb = in_bbox(xyz.detach())
 
         if labels is not None:
             self.labels = in_bb * labels
@@ -166,8 +165,7 @@ class HGPIFuNetwNML(BasePIFuNet):
 
         phi = None
         for i, im_feat in enumerate(self.im_feat_list):
-            point_local_feat_list = [self.index(im_feat, xy), sp_feat]       
-            point_local_feat = torch.cat(point_local_feat_list, 1)
+            point_local_feat = index_feat(im_feat, xy, sp_feat, self.get_feat_buffer(im_feat, sp_feat))
             pred, phi = self.mlp(point_local_feat)
             pred = in_bb * pred
 
@@ -180,7 +178,7 @@ class HGPIFuNetwNML(BasePIFuNet):
             self.intermediate_preds_list = intermediate_preds_list
             self.preds = self.intermediate_preds_list[-1]
 
-    def calc_normal(self, points, calibs, transforms=None, labels=None, delta=0.01, fd_type='forward'):
+    def calc_normal(self, points, calibs, transforms=None, labels=None, delta=0.01, fd_type='forward', chunk_size=None):
         '''
         return surface normal in 'model' space.
         it computes normal only in the last stack.
@@ -191,39 +189,26 @@ class HGPIFuNetwNML(BasePIFuNet):
             transforms: [B, 2, 3] image space coordinate transforms
             delta: perturbation for finite difference
             fd_type: finite difference type (forward/backward/central) 
+            chunk_size: if set, the mlp is evaluated on at most chunk_size points at once
         '''
-        pdx = points.clone()
-        pdx[:,0,:] += delta
-        pdy = points.clone()
-        pdy[:,1,:] += delta
-        pdz = points.clone()
-        pdz[:,2,:] += delta
-
         if labels is not None:
             self.labels_nml = labels
 
-        points_all = torch.stack([points, pdx, pdy, pdz], 3)
-        points_all = points_all.view(*points.size()[:2],-1)
+        points_all = self.perturb_points(points, delta)
         xyz = self.projection(points_all, calibs, transforms)
         xy = xyz[:, :2, :]
 
         im_feat = self.im_feat_list[-1]
         sp_feat = self.spatial_enc(xyz, calibs=calibs)
 
-        point_local_feat_list = [self.index(im_feat, xy), sp_feat]            
-        point_local_feat = torch.cat(point_local_feat_list, 1)
-
-        pred = self.mlp(point_local_feat)[0]
-
-        pred = pred.view(*pred.size()[:2],-1,4) # (B, 1, N, 4)
+        point_local_feat = index_feat(im_feat, xy, sp_feat, self.get_feat_buffer(im_feat, sp_feat))
 
-        # divide by delta is omitted since it's normalized anyway
-        dfdx = pred[:,:,:,1] - pred[:,:,:,0]
-        dfdy = pred[:,:,:,2] - pred[:,:,:,0]
-        dfdz = pred[:,:,:,3] - pred[:,:,:,0]
+        # each point comes with its 3 perturbed copies, so chunks are 4x wider
+        step = point_local_feat.size(2) if chunk_size is None else 4 * chunk_size
+        pred = torch.cat([self.mlp(point_local_feat[:,:,left:left+step])[0]
+                          for left in range(0, point_local_feat.size(2), step)], 2)
 
-        nml = -torch.cat([dfdx,dfdy,dfdz], 1)
-        nml = F.normalize(nml, dim=1, eps=1e-8)
+        nml = fd_normal(pred)
 
         self.nmls = nml
 
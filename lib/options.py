@@ -167,6 +167,10 @@ class BaseOptions():
         # for reconstruction
         parser.add_argument('--start_id', type=int, default=-1, help='load size of input image')
         parser.add_argument('--end_id', type=int, default=-1, help='load size of input image')
+        parser.add_argument('--num_samples', type=int, default=50000, help='# of points queried at once in reconstruction. larger is faster if memory allows (e.g. 1000000)')
+        parser.add_argument('--save_viz', action='store_true', help='append predicted normal maps to the saved input image')
+        parser.add_argument('--use_amp', action='store_true', help='run inference under fp16 autocast')
+        parser.add_argument('--use_compile', action='store_true', help='compile the mlps with torch.compile (pytorch >= 2.0)')
 
         # special tasks
         self.initialized = True
@@ -54,24 +54,19 @@ def batch_eval(points, eval_func, num_samples=512 * 512 * 512):
     num_pts = points.shape[1]
     sdf = np.zeros(num_pts)
 
-    num_batches = num_pts // num_samples
-    for i in range(num_batches):
-        sdf[i * num_samples:i * num_samples + num_samples] = eval_func(
-            points[:, i * num_samples:i * num_samples + num_samples])
-    if num_pts % num_samples:
-        sdf[num_batches * num_samples:] = eval_func(points[:, num_batches * num_samples:])
+    for left in range(0, num_pts, num_samples):
+        right = min(left + num_samples, num_pts)
+        sdf[left:right] = eval_func(points[:, left:right])
 
     return sdf
 
 def batch_eval_tensor(points, eval_func, num_samples=512 * 512 * 512):
     num_pts = points.size(1)
 
-    num_batches = num_pts // num_samples
     vals = []
-    for i in range(num_batches):
-        vals.append(eval_func(points[:, i * num_samples:i * num_samples + num_samples]))
-    if num_pts % num_samples:
-        vals.append(eval_func(points[:, num_batches * num_samples:]))
+    for left in range(0, num_pts, num_samples):
+        right = min(left + num_samples, num_pts)
+        vals.append(eval_func(points[:, left:right]))
 
     return np.concatenate(vals,0)
 